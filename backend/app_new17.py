@@ -1,117 +1,415 @@
 import argparse
+import io
+import logging
+import os
 import time
 from functools import lru_cache
 import threading
 import json
-from queue import Queue
+from collections import deque
+from contextlib import contextmanager
 
 import cv2
+import numpy as np
+import orjson
+from numba import njit
 from picamera2 import MappedArray, Picamera2
 from picamera2.devices.imx500 import IMX500
+from picamera2.encoders import MJPEGEncoder, Quality
+from picamera2.outputs import FileOutput
 from flask import Flask, Response
 from flask_socketio import SocketIO, emit
+from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_RGBX, TJSAMP_420
+
+# Camera-thread logger; per-frame messages are DEBUG so they cost nothing by default
+log = logging.getLogger("det")
+log.setLevel(logging.WARNING)
+CONVERSION_WARN_EVERY = 100  # Log the first coordinate conversion failure, then every Nth one
+conversion_failures = 0
 
 # Global variables with locks for thread safety
-latest_detections = []
+# latest_detections: parallel arrays "boxes" int32 (N, 4), "scores" float32 (N,), "cats" int32 (N,)
+EMPTY_DETECTIONS = {
+    "boxes": np.empty((0, 4), dtype=np.int32),
+    "scores": np.empty(0, dtype=np.float32),
+    "cats": np.empty(0, dtype=np.int32),
+}
+latest_detections = EMPTY_DETECTIONS
 detections_lock = threading.Lock()
-frame_queue = Queue(maxsize=10)  # Buffer for streaming frames
+# Preallocated streaming buffers; only the newest published slot is kept for the stream
+FRAME_POOL_SIZE = 4
+frame_pool = []
+free_slots = deque()
 PRODUCTS = None
+LABELS = ()  # Filled once from get_labels() at startup
+LABEL_CACHE_SIZE = 4096
+JPEG_QUALITY = 75
+# libjpeg-turbo pixel format by channel count; the default XBGR8888 main stream is R,G,B,X in memory
+JPEG_PIXEL_FORMATS = {3: TJPF_RGB, 4: TJPF_RGBX}
+FRAME_WIDTH, FRAME_HEIGHT = 640, 480
+FRAME_BOUNDS = np.array([FRAME_WIDTH, FRAME_HEIGHT, FRAME_WIDTH, FRAME_HEIGHT], dtype=np.float32)
+stream_output = None  # Set when JPEGs come from the hardware encoder instead of the encoder thread
+# Dedicated cores for the real-time threads on a 4-core Pi
+CAMERA_CPU, ENCODER_CPU, EMITTER_CPU, SERVER_CPU = 0, 1, 2, 3
+camera_thread = threading.local()  # Marks the picamera2 callback thread once it has been pinned
+stream_clients = 0  # Number of open /video_feed responses
+stream_clients_lock = threading.Lock()
+
+# Overlay style shared by the label cache and the box drawing
+LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+LABEL_SCALE = 0.5
+LABEL_THICKNESS = 2
+OVERLAY_COLOR = (0, 255, 0)
+LABEL_PIXEL = np.array([0, 255, 0, 0], dtype=np.uint8)  # OVERLAY_COLOR padded for 4-channel frames
 
 # Global variables for detection control and ingredient aggregation
 detection_active = False
-# detected_ingredients: key: ingredient label, value: dict with keys: total_weight, count, avg_weight, last_update
-detected_ingredients = {}
+dashboard_dirty = False  # Set when the dashboard must be re-sent outside of a quantity change
+
+
+class OrjsonModule:
+    """json-module shim so Socket.IO packets are serialized with orjson."""
+
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        # python-socketio passes stdlib options such as separators; orjson output is already compact
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
+
 
 # Initialize Flask app and SocketIO
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading", json=OrjsonModule)
+
+
+class LatestSlot:
+    """Single-slot register that keeps only the most recently published value."""
+
+    def __init__(self):
+        self.buf = None
+        self.cv = threading.Condition()
+
+
+latest_frame = LatestSlot()  # Holds the frame_pool index of the newest frame
+
+
+class EncodedSlot:
+    """Latest encoded JPEG frame and its sequence number, shared by every stream client."""
+
+    def __init__(self):
+        self.seq = -1
+        self.jpeg = None
+        self.cv = threading.Condition()
+
+    def publish(self, jpeg):
+        with self.cv:
+            self.seq += 1
+            self.jpeg = jpeg
+            self.cv.notify_all()
+
+
+encoded_frame = EncodedSlot()
+
+
+class IngredientTally:
+    """Per-session product tally kept as parallel arrays, indexed through a label map."""
+
+    def __init__(self, capacity):
+        self.labels = []
+        self.index_of = {}
+        self.quantities = np.zeros(capacity, dtype=np.int32)
+        self.last_update = np.zeros(capacity, dtype=np.float64)
+        self.prices = np.zeros(capacity, dtype=np.float64)
+
+    def add(self, label, price, timestamp):
+        """Start tracking a newly seen product with a quantity of one."""
+        i = len(self.labels)
+        self.index_of[label] = i
+        self.labels.append(label)
+        self.quantities[i] = 1
+        self.last_update[i] = timestamp
+        self.prices[i] = price
+
+    def to_payload(self):
+        """Return the tally as the list of product dicts sent to the dashboard."""
+        n = len(self.labels)
+        return [
+            {"name": label, "quantity": quantity, "price": price}
+            for label, quantity, price in zip(self.labels, self.quantities[:n].tolist(), self.prices[:n].tolist())
+        ]
+
 
+# Created once LABELS is loaded and replaced with a fresh tally whenever detection starts
+detected_ingredients = None
 
-class Detection:
-    def __init__(self, coords, category, conf, metadata):
-        """Create a Detection object with bounding box, category, and confidence."""
-        self.category = category
-        self.conf = conf
+
+class StreamingOutput(io.BufferedIOBase):
+    """File-like sink that publishes the hardware MJPEG encoder's frames to the encoded slot."""
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def write(self, buf):
+        self.slot.publish(buf)
+
+
+def pin_current_thread(cpu, niceness=0, name="thread"):
+    """Pin the calling thread to one core and optionally raise its priority."""
+    if cpu < (os.cpu_count() or 1):
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (AttributeError, OSError) as e:
+            print(f"Error pinning {name} to CPU {cpu}: {e}")
+    if niceness:
         try:
-            self.box = imx500.convert_inference_coords(coords, metadata, picam2)
-            # Ensure box coordinates are valid integers and within frame bounds (640x480)
-            self.box = [int(max(0, min(val, 640 if i % 2 == 0 else 480))) for i, val in enumerate(self.box)]
-        except Exception as e:
-            print(f"Error converting coordinates: {e}")
-            # Fallback to scaling raw coordinates assuming normalized [0,1]
-            self.box = [int(val * (640 if i % 2 == 0 else 480)) for i, val in enumerate(coords)]
+            os.nice(niceness)
+        except OSError as e:
+            print(f"Could not renice {name}: {e}")
+
+
+def make_detections(boxes=None, scores=None, cats=None):
+    """Build a detection batch as parallel arrays: int32 boxes (N, 4), float32 scores and int32 categories."""
+    return {
+        "boxes": np.empty((0, 4), dtype=np.int32) if boxes is None else boxes,
+        "scores": np.empty(0, dtype=np.float32) if scores is None else scores,
+        "cats": np.empty(0, dtype=np.int32) if cats is None else cats,
+    }
+
+
+@njit(cache=True)
+def _postprocess(boxes, scores, classes, thr):
+    """Keep detections scoring at least thr, returning float32 boxes, float32 scores and int32 classes."""
+    n = 0
+    for i in range(scores.shape[0]):
+        if scores[i] >= thr:
+            n += 1
+    out_b = np.empty((n, 4), np.float32)
+    out_s = np.empty(n, np.float32)
+    out_c = np.empty(n, np.int32)
+    j = 0
+    for i in range(scores.shape[0]):
+        if scores[i] >= thr:
+            for k in range(4):
+                out_b[j, k] = boxes[i, k]
+            out_s[j] = scores[i]
+            out_c[j] = int(classes[i])
+            j += 1
+    return out_b, out_s, out_c
+
+
+@njit(cache=True)
+def _clamp_boxes(boxes, width, height):
+    """Clamp (x, y, w, h) boxes to the frame and truncate them to int32."""
+    out = np.empty((boxes.shape[0], 4), np.int32)
+    for i in range(boxes.shape[0]):
+        for k in range(4):
+            limit = width if k % 2 == 0 else height
+            v = boxes[i, k]
+            if v < 0:
+                v = 0
+            elif v > limit:
+                v = limit
+            out[i, k] = int(v)
+    return out
+
+
+def warm_up_kernels(threshold):
+    """Compile the Numba kernels with the camera's dtypes so the callback never pays for the JIT."""
+    boxes = np.zeros((1, 4), dtype=np.float32)
+    scores = np.ones(1, dtype=np.float32)
+    classes = np.zeros(1, dtype=np.float32)
+    boxes_f, _, _ = _postprocess(boxes, scores, classes, threshold)
+    _clamp_boxes(boxes_f, FRAME_WIDTH, FRAME_HEIGHT)
+
+
+def convert_boxes(coords, metadata):
+    """Convert inference boxes to frame coordinates and clamp them to the 640x480 frame."""
+    global conversion_failures
+    # One guard for the whole batch instead of one per box
+    try:
+        converted = np.array(
+            [imx500.convert_inference_coords(box, metadata, picam2) for box in coords], dtype=np.float32
+        ).reshape(-1, 4)
+    except Exception as e:
+        conversion_failures += 1
+        if conversion_failures % CONVERSION_WARN_EVERY == 1:
+            log.warning("Error converting coordinates (%d failures so far): %s", conversion_failures, e)
+        # Fallback to scaling raw coordinates assuming normalized [0,1]
+        converted = np.asarray(coords, dtype=np.float32).reshape(-1, 4) * FRAME_BOUNDS
+    return _clamp_boxes(converted, FRAME_WIDTH, FRAME_HEIGHT)
 
 
 def pre_callback(request):
-    """Process detections, draw bounding boxes on the main frame, and queue the frame for streaming."""
-    metadata = request.get_metadata()
-    np_outputs = imx500.get_outputs(metadata, add_batch=True)
-    detections = []
+    """Process detections, draw bounding boxes on the main frame, and publish it as the latest streaming frame.
+
+    Inference outputs are only post-processed while detection is active, and
+    the frame is only drawn and published while a stream client is connected.
+    """
+    global latest_detections
+    if not getattr(camera_thread, "pinned", False):
+        pin_current_thread(CAMERA_CPU, niceness=-5, name="camera thread")
+        camera_thread.pinned = True
+    active = detection_active
+    if not active and stream_clients == 0:
+        # No consumer at all; drop any stale batch so a later start does not count it
+        if latest_detections is not EMPTY_DETECTIONS:
+            with detections_lock:
+                latest_detections = EMPTY_DETECTIONS
+        return
+
+    detections = make_detections()
+    np_outputs = None
+    if active:
+        metadata = request.get_metadata()
+        np_outputs = imx500.get_outputs(metadata, add_batch=True)
     if np_outputs is not None:
         boxes, scores, classes = np_outputs[0][0], np_outputs[2][0], np_outputs[1][0]
-        filtered_detections = [
-            (box, score, category)
-            for box, score, category in zip(boxes, scores, classes)
-            if score >= args.threshold
-        ]
-        print(f"Found {len(filtered_detections)} detections above threshold")
-        for box, score, category in filtered_detections:
-            try:
-                det = Detection(box, category, score, metadata)
-                detections.append(det)
-                print(f"Added detection for category {category} with confidence {score:.2f}")
-            except Exception as e:
-                print(f"Error creating detection: {e}")
+        boxes_f, scores_f, classes_f = _postprocess(boxes, scores, classes, args.threshold)
+        log.debug("Found %d detections above threshold", len(scores_f))
+        detections = make_detections(convert_boxes(boxes_f, metadata), scores_f, classes_f)
+        if log.isEnabledFor(logging.DEBUG):
+            for category, score in zip(classes_f, scores_f):
+                log.debug("Added detection for category %s with confidence %.2f", category, score)
     
-    # Update global detections for WebSocket (regardless of detection mode)
+    # Update global detections for WebSocket
     with detections_lock:
-        global latest_detections
         latest_detections = detections
     
+    # Nobody is watching the stream, so there is nothing to draw or publish
+    if stream_clients == 0:
+        return
+
     # Draw detections on the main stream
     with MappedArray(request, "main") as m:
-        labels = get_labels()
-        for detection in detections:
-            x, y, w, h = detection.box
-            label = f"{labels[int(detection.category)]} ({detection.conf:.2f})"
-            cv2.putText(
-                m.array,
-                label,
-                (x + 5, y + 15),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.5,
-                (0, 255, 0),
-                2,
-            )
-            cv2.rectangle(m.array, (x, y), (x + w, y + h), (0, 255, 0), 2)
-        if not frame_queue.full():
-            frame_queue.put(m.array.copy())
+        for (x, y, w, h), category, conf in zip(
+            detections["boxes"].tolist(), detections["cats"].tolist(), detections["scores"].tolist()
+        ):
+            # Confidence is bucketed to the two decimals shown, so labels hit the patch cache
+            draw_label(m.array, category, round(conf * 100), x + 5, y + 15)
+            cv2.rectangle(m.array, (x, y), (x + w, y + h), OVERLAY_COLOR, 2)
+        # The hardware encoder consumes this buffer after the callback returns
+        if stream_output is None:
+            publish_frame(m.array)
+
+
+@lru_cache(maxsize=LABEL_CACHE_SIZE)
+def _label_patch(category, conf_pct):
+    """Rasterize a category/confidence label once into a boolean glyph mask, returning (mask, ascent)."""
+    text = f"{LABELS[category]} ({conf_pct / 100:.2f})"
+    (w, h), baseline = cv2.getTextSize(text, LABEL_FONT, LABEL_SCALE, LABEL_THICKNESS)
+    pad = LABEL_THICKNESS
+    canvas = np.zeros((h + baseline + 2 * pad, w + 2 * pad), dtype=np.uint8)
+    cv2.putText(canvas, text, (pad, pad + h), LABEL_FONT, LABEL_SCALE, 255, LABEL_THICKNESS)
+    mask = canvas.astype(bool)
+    mask.flags.writeable = False
+    return mask, pad + h
+
+
+def preload_label_patches(threshold):
+    """Rasterize every label/confidence pair that can pass the threshold, when they all fit in the cache."""
+    buckets = range(int(threshold * 100), 101)
+    if len(LABELS) * len(buckets) > LABEL_CACHE_SIZE:
+        return
+    for category in range(len(LABELS)):
+        for conf_pct in buckets:
+            _label_patch(category, conf_pct)
+
+
+def draw_label(array, category, conf_pct, x, y):
+    """Blit a cached label onto the frame with its text origin at (x, y), like cv2.putText."""
+    mask, ascent = _label_patch(category, conf_pct)
+    top, left = y - ascent, x - LABEL_THICKNESS
+    y0, x0 = max(top, 0), max(left, 0)
+    y1 = min(top + mask.shape[0], array.shape[0])
+    x1 = min(left + mask.shape[1], array.shape[1])
+    if y1 <= y0 or x1 <= x0:
+        return
+    region = array[y0:y1, x0:x1]
+    region[mask[y0 - top:y1 - top, x0 - left:x1 - left]] = LABEL_PIXEL[:array.shape[2]]
+
+
+@contextmanager
+def track_stream_client():
+    """Count an open /video_feed response for as long as its generator runs."""
+    global stream_clients
+    with stream_clients_lock:
+        stream_clients += 1
+    try:
+        yield
+    finally:
+        with stream_clients_lock:
+            stream_clients -= 1
+
+
+def publish_frame(array):
+    """Copy a frame into a free pool slot and make it the latest frame for streaming."""
+    if not frame_pool:
+        frame_pool.extend(np.empty_like(array) for _ in range(FRAME_POOL_SIZE))
+        free_slots.extend(range(FRAME_POOL_SIZE))
+    with latest_frame.cv:
+        if not free_slots:
+            return  # Every buffer is being encoded; skip this frame
+        i = free_slots.popleft()
+    np.copyto(frame_pool[i], array)
+    with latest_frame.cv:
+        if latest_frame.buf is not None:
+            free_slots.append(latest_frame.buf)  # Discard the stale frame nobody picked up
+        latest_frame.buf = i
+        latest_frame.cv.notify()
 
 
-@lru_cache
 def get_labels():
-    """Load and cache labels from the labels file."""
+    """Load labels from the labels file as a tuple."""
     try:
         with open(args.labels, 'r') as f:
-            labels = [line.strip() for line in f.readlines()]
+            labels = tuple(line.strip() for line in f.readlines())
         print(f"Loaded {len(labels)} labels from {args.labels}")
         return labels
     except Exception as e:
         print(f"Error loading labels: {e}")
-        return []
+        return ()
 
 
-def generate_frames():
-    """Generate MJPEG frames for video streaming from the queue."""
+def encode_frames():
+    """Encode each published frame exactly once and share the JPEG with all stream clients."""
+    pin_current_thread(ENCODER_CPU, name="encoder thread")
     while True:
-        if not frame_queue.empty():
-            frame = frame_queue.get()
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            ret, buffer = cv2.imencode('.jpg', rgb_frame)
+        # Block until the camera thread publishes a frame instead of polling
+        with latest_frame.cv:
+            latest_frame.cv.wait_for(lambda: latest_frame.buf is not None)
+            i, latest_frame.buf = latest_frame.buf, None
+        # libjpeg-turbo reads the channel order directly, so no cvtColor copy is needed
+        frame = frame_pool[i]
+        buffer = jpeg.encode(
+            frame,
+            quality=JPEG_QUALITY,
+            pixel_format=JPEG_PIXEL_FORMATS[frame.shape[2]],
+            jpeg_subsample=TJSAMP_420,
+        )
+        with latest_frame.cv:
+            free_slots.append(i)
+        encoded_frame.publish(buffer)
+
+
+def generate_frames():
+    """Generate MJPEG frames for video streaming from the shared encoded slot.
+
+    Each client remembers the last sequence number it sent, so a client that
+    is slower than the camera skips straight to the newest frame.
+    """
+    with track_stream_client():
+        # Start from the current frame so a new client never gets a stale JPEG from an earlier viewer
+        with encoded_frame.cv:
+            last_seq = encoded_frame.seq
+        while True:
+            with encoded_frame.cv:
+                encoded_frame.cv.wait_for(lambda: encoded_frame.seq > last_seq)
+                last_seq, frame = encoded_frame.seq, encoded_frame.jpeg
             yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-        else:
-            time.sleep(0.01)
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
 
 
 @app.route('/video_feed')
@@ -223,16 +521,19 @@ def index():
 
 @socketio.on('start_detection')
 def handle_start_detection():
-    global detection_active, detected_ingredients
+    global detection_active, detected_ingredients, dashboard_dirty
+    # Publish the new tally before the flags, so the emitter never counts into the old one
+    detected_ingredients = IngredientTally(len(LABELS))  # Reset accumulated data for new detection
+    dashboard_dirty = True
     detection_active = True
-    detected_ingredients = {}  # Reset accumulated data for new detection
     print("Detection started.")
 
 
 @socketio.on('stop_detection')
 def handle_stop_detection():
-    global detection_active
+    global detection_active, dashboard_dirty
     detection_active = False
+    dashboard_dirty = True
     print("Detection stopped.")
 
 
@@ -242,53 +543,52 @@ def emit_detections():
     While detection is active:
       - Track product name, quantity, and price
       - Increment quantity when product is detected again after threshold delay
+
+    The dashboard is only emitted when its contents change, plus a periodic
+    resend so newly connected clients catch up.
     """
+    global dashboard_dirty
+    pin_current_thread(EMITTER_CPU, name="emitter thread")
     weight_update_threshold = 2.0  # seconds
+    resend_interval = 2.0  # seconds
+    label_of = LABELS.__getitem__
+    data_list = []
+    last_emit = 0.0
     while True:
         current_time = time.time()
-        # Copy the current detections for processing
+        dirty = False
+        # Read the flags before the tally: the start handler swaps the tally in first
+        if dashboard_dirty:
+            dashboard_dirty = False
+            dirty = True
+        active = detection_active
+        tally = detected_ingredients
+        # Batches are replaced wholesale, so grabbing the reference is enough
         with detections_lock:
-            current_detections = list(latest_detections)
+            current_cats = latest_detections["cats"]
         
-        if detection_active:
-            # Process detections: update detected_ingredients with quantity
-            for det in current_detections:
-                label = get_labels()[int(det.category)]
-                if label not in detected_ingredients:
-                    detected_ingredients[label] = {
-                        "quantity": 1,
-                        "last_update": current_time,
-                    }
-                else:
-                    # Update only if a certain time has passed to avoid over-counting
-                    if current_time - detected_ingredients[label]["last_update"] >= weight_update_threshold:
-                        d = detected_ingredients[label]
-                        d["quantity"] += 1
-                        d["last_update"] = current_time
-
-            # Prepare data for emission during active detection
-            data_list = []
-            for label, info in detected_ingredients.items():
-                product_info = PRODUCTS.get(label, {})
-                price = product_info.get("price", 0)
-                data_list.append({
-                    "name": label,
-                    "quantity": info["quantity"],
-                    "price": price
-                })
-            socketio.emit('detection_update', {"products": data_list})
-        else:
-            # When detection is stopped, emit final data
-            data_list = []
-            for label, info in detected_ingredients.items():
-                product_info = PRODUCTS.get(label, {})
-                price = product_info.get("price", 0)
-                data_list.append({
-                    "name": label,
-                    "quantity": info["quantity"],
-                    "price": price
-                })
+        if active:
+            # Process detections: update the tally with quantity
+            for category in current_cats.tolist():
+                label = label_of(category)
+                i = tally.index_of.get(label)
+                if i is None:
+                    # Look the price up once when the product is first seen
+                    tally.add(label, PRODUCTS.get(label, {}).get("price", 0), current_time)
+                    dirty = True
+                # Update only if a certain time has passed to avoid over-counting
+                elif current_time - tally.last_update[i] >= weight_update_threshold:
+                    tally.quantities[i] += 1
+                    tally.last_update[i] = current_time
+                    dirty = True
+
+        if dirty:
+            # Rebuild the cached payload only when the aggregated data changed
+            data_list = tally.to_payload()
+
+        if dirty or current_time - last_emit >= resend_interval:
             socketio.emit('detection_update', {"products": data_list})
+            last_emit = current_time
         time.sleep(0.1)
 
 
@@ -298,15 +598,18 @@ def add_test_detections():
     Cycles through different product categories to simulate scanning multiple products.
     """
     category = 0  # Start with first product
-    max_category = len(get_labels()) - 1  # Get number of available products
+    max_category = len(LABELS) - 1  # Get number of available products
     
     while True:
         with detections_lock:
             global latest_detections
             # Create a test detection with current category
-            test_detection = Detection([100, 100, 200, 150], category, 0.95, {"ScalerCrop": (480, 640)})
-            latest_detections = [test_detection]
-            label = get_labels()[category]
+            latest_detections = make_detections(
+                convert_boxes([[100, 100, 200, 150]], {"ScalerCrop": (480, 640)}),
+                np.array([0.95], dtype=np.float32),
+                np.array([category], dtype=np.int32),
+            )
+            label = LABELS[category]
             print(f"Added test detection for {label}")
             
             # Move to next category, loop back to 0 if at end
@@ -324,11 +627,18 @@ def get_args():
     parser.add_argument("--labels", type=str, default="assets/labels.txt", help="Path to labels file")
     parser.add_argument("--products", type=str, default="products.json", help="Path to product details JSON")
     parser.add_argument("--test-mode", action="store_true", help="Run with test detections")
+    parser.add_argument("--hw-encoder", action="store_true", help="Encode the stream with the VideoCore MJPEG encoder")
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = get_args()
+    LABELS = get_labels()
+    detected_ingredients = IngredientTally(len(LABELS))
+    # Render label text before the camera starts so the callback never rasterizes glyphs
+    preload_label_patches(args.threshold)
+    # Same for the Numba kernels, which would otherwise compile on the first detection frame
+    warm_up_kernels(args.threshold)
 
     # Initialize IMX500 and Picamera2
     imx500 = IMX500(args.model)
@@ -348,6 +658,16 @@ if __name__ == "__main__":
     # Start the camera
     picam2.start(config, show_preview=True)
 
+    # Hand JPEG encoding to the V4L2 M2M encoder; overlays from pre_callback are already on the frame
+    if args.hw_encoder:
+        stream_output = StreamingOutput(encoded_frame)
+        # The V4L2 MJPEG encoder is bitrate-driven; Quality.HIGH is the closest match to q=80
+        picam2.start_encoder(MJPEGEncoder(), FileOutput(stream_output), quality=Quality.HIGH)
+    else:
+        # libjpeg-turbo handle used by the encoder thread
+        jpeg = TurboJPEG()
+        threading.Thread(target=encode_frames, daemon=True).start()
+
     # Start test detections if enabled
     if args.test_mode:
         threading.Thread(target=add_test_detections, daemon=True).start()
@@ -356,5 +676,6 @@ if __name__ == "__main__":
     # Start WebSocket emitter for updating dashboard
     threading.Thread(target=emit_detections, daemon=True).start()
 
-    # Run Flask app with Socket.IO
+    # Run Flask app with Socket.IO; request threads inherit the main thread's core
+    pin_current_thread(SERVER_CPU, name="server thread")
     socketio.run(app, host='0.0.0.0', port=5000)